@@ -1,56 +1,56 @@
 import sys
 import math
+import re
 import argparse
 import json
 import pathlib
-import subprocess
+import concurrent.futures
+import numpy as np
 import bpy
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class ArgumentParserForBlender(argparse.ArgumentParser):
+
+# Matches file names like 'CYQ_0001.MP4' and captures the number.
+CYQ_FILENAME_RE = re.compile(r'CYQ_(\d+)\.MP4$', re.IGNORECASE)
+
+# Audio channels of even and odd incidents; video goes one channel above.
+INCIDENT_CHANNELS = (1, 3)
+
+
+def get_argv_after_doubledash():
     """
-    This class is identical to its superclass, except for the parse_args
-    method (see docstring). It resolves the ambiguity generated when calling
-    Blender from the CLI with a python script, and both Blender and the script
-    have arguments. E.g., the following call will make Blender crash because
-    it will try to process the script's -a and -b flags:
+    Given the sys.argv as a list of strings, this function returns the
+    sublist right after the '--' element (if present, otherwise returns
+    an empty list).
+
+    This resolves the ambiguity generated when calling Blender from the CLI
+    with a python script, and both Blender and the script have arguments.
+    E.g., the following call will make Blender crash because it will try
+    to process the script's -a and -b flags:
     >>> blender --python my_script.py -a 1 -b 2
 
-    To bypass this issue this class uses the fact that Blender will ignore all
+    To bypass this issue we use the fact that Blender will ignore all
     arguments given after a double-dash ('--'). The approach is that all
     arguments before '--' go to Blender, arguments after go to the script.
     The following calls work fine:
     >>> blender --python my_script.py -- -a 1 -b 2
     >>> blender --python my_script.py --
 
-    From https://blender.stackexchange.com/a/134596
+    Adapted from https://blender.stackexchange.com/a/134596
     """
-
-    def _get_argv_after_doubledash(self):
-        """
-        Given the sys.argv as a list of strings, this method returns the
-        sublist right after the '--' element (if present, otherwise returns
-        an empty list).
-        """
-        try:
-            idx = sys.argv.index("--")
-            return sys.argv[idx+1:]  # the list after '--'
-        except ValueError:  # '--' not in the list:
-            return []
-
-    # overrides superclass
-    def parse_args(self):
-        """
-        This method is expected to behave identically as in the superclass,
-        except that the sys.argv list will be pre-processed using
-        _get_argv_after_doubledash before. See the docstring of the class for
-        usage examples and details.
-        """
-        return super().parse_args(args=self._get_argv_after_doubledash())
+    try:
+        idx = sys.argv.index("--")
+        return sys.argv[idx+1:]  # the list after '--'
+    except ValueError:  # '--' not in the list:
+        return []
 
 
 def blender_main():
-    parser = ArgumentParserForBlender()
+    parser = argparse.ArgumentParser()
     parser.add_argument(
         "file",
         help="Name of the blend file to save",
@@ -72,53 +72,158 @@ def blender_main():
         help="Seconds of context after a beep.",
         default=5,
     )
-    args = parser.parse_args()
+    args = parser.parse_args(args=get_argv_after_doubledash())
 
     bpy.context.preferences.view.show_splash = False
-    bpy.ops.wm.read_homefile(app_template="Video_Editing")
 
-    # `AttributeError: 'Screen' object has no attribute 'params':
-    # bpy.data.screens["Video Editing"].params.directory = "//"
-
-    with open(args.incidents_json, 'r') as f:
-        incident_times_by_video = json.load(f)
-    if len(incident_times_by_video) == 0:
+    if orjson is not None:
+        incident_times_by_video = orjson.loads(
+            args.incidents_json.read_bytes()
+        )
+    else:
+        with open(args.incidents_json, 'r') as f:
+            incident_times_by_video = json.load(f)
+    # dashcam-detect.py lists every video, including those without beeps.
+    # If there are no beeps at all, don't bother setting anything up:
+    if not any(incident_times_by_video.values()):
         print("No incidents found")
         return
 
+    if not bpy.app.background:
+        # Reloading the startup file is slow, and the Video Editing
+        # workspace is only of use if there is a UI to look at it.
+        # Otherwise, the default scene's sequence editor will do.
+        bpy.ops.wm.read_homefile(app_template="Video_Editing")
+
+    # `AttributeError: 'Screen' object has no attribute 'params':
+    # bpy.data.screens["Video Editing"].params.directory = "//"
+
     # We'll assume that all videos have the same resolution and frame rate.
-    # -> Set Blender settings according to the first video:
-    exif = get_exif(sorted(incident_times_by_video.keys())[0])
-    bpy.context.scene.render.resolution_x = int(exif['Source Image Width'])
-    bpy.context.scene.render.resolution_y = int(exif['Source Image Height'])
-    fps = float(exif['Video Frame Rate'])
-    bpy.context.scene.render.fps = math.ceil(fps)
-    bpy.context.scene.render.fps_base = math.ceil(fps) / fps
-
-    i_incident = 0
-    for video_filename in sorted(incident_times_by_video.keys()):
-        for beep_timestamp in incident_times_by_video[video_filename]:
+    # -> Set Blender settings according to the first video, but warn if
+    # that assumption doesn't hold.
+    # ffprobe spends most of its time starting up and waiting for I/O,
+    # so probe all videos in parallel:
+    video_filenames = sorted(
+        video_filename
+        for video_filename, beeps in incident_times_by_video.items()
+        if beeps
+    )
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(8, len(video_filenames)),
+    ) as executor:
+        all_metadata = list(
+            executor.map(get_video_metadata, video_filenames)
+        )
+    metadata = all_metadata[0]
+    for video_filename, other_metadata in zip(
+        video_filenames[1:], all_metadata[1:]
+    ):
+        if other_metadata != metadata:
+            print(
+                f"Warning: {video_filename} ({other_metadata}) differs "
+                f"from {video_filenames[0]} ({metadata})"
+            )
+    scene_render = bpy.context.scene.render
+    scene_render.resolution_x = metadata['width']
+    scene_render.resolution_y = metadata['height']
+    fps = metadata['fps']
+    # Blender wants an integer frame rate plus a divisor, e.g.,
+    # 30 / 1.001 for 29.97 fps:
+    fps_int = math.ceil(fps)
+    scene_render.fps = fps_int
+    scene_render.fps_base = fps_int / fps
+
+    # Work out where each incident goes first so that the loop creating
+    # the strips does nothing but create strips.
+    # All (video_filename, beep_timestamp) pairs in timeline order:
+    video_beeps = [
+        (video_filename, beep_timestamp)
+        for video_filename in video_filenames
+        for beep_timestamp in incident_times_by_video[video_filename]
+    ]
+    beep_timestamps = np.fromiter(
+        (beep_timestamp for _, beep_timestamp in video_beeps),
+        dtype=np.float64,
+        count=len(video_beeps),
+    )
+    # Each incident takes up the same number of frames in the timeline:
+    frame_stride = (args.context_before + args.context_after) * fps
+    i_incidents = np.arange(len(beep_timestamps))
+    start_frames = (i_incidents * frame_stride).astype(np.int64)
+    # Seconds of the video before the beep that we can't show because the
+    # video starts too late (gap for prev context clip), and seconds of the
+    # video before the beep that we don't want to show:
+    missing_context = np.maximum(0, args.context_before - beep_timestamps)
+    skipped_video = np.maximum(0, beep_timestamps - args.context_before)
+    frame_starts = (
+        start_frames
+        + missing_context * fps
+        - skipped_video * fps
+    ).astype(np.int64)
+    frame_offset_starts = (skipped_video * fps).astype(np.int64)
+    frame_final_durations = (
+        (
+            np.minimum(args.context_before, beep_timestamps)
+            + args.context_after
+        )
+        * fps
+    ).astype(np.int64)
+    # Alternate between two pairs of audio and video channels so that
+    # neighboring incidents can be told apart:
+    channels = np.array(INCIDENT_CHANNELS)[i_incidents % 2]
+
+    incidents = [
+        dict(
+            video_filename=video_filename,
+            beep_timestamp=beep_timestamp,
+            start_frame=start_frame,
+            frame_start=frame_start,
+            frame_offset_start=frame_offset_start,
+            frame_final_duration=frame_final_duration,
+            channel=channel,
+        )
+        # tolist() gives us plain Python ints for bpy:
+        for (
+            (video_filename, beep_timestamp),
+            start_frame,
+            frame_start,
+            frame_offset_start,
+            frame_final_duration,
+            channel,
+        ) in zip(
+            video_beeps,
+            start_frames.tolist(),
+            frame_starts.tolist(),
+            frame_offset_starts.tolist(),
+            frame_final_durations.tolist(),
+            channels.tolist(),
+        )
+    ]
+
+    sequences = bpy.context.scene.sequence_editor_create().sequences
+    # Whether a neighbor clip exists, by path; shared by all incidents:
+    video_exists = dict()
+
+    # Every strip we add would otherwise push an undo step.
+    use_global_undo = bpy.context.preferences.edit.use_global_undo
+    bpy.context.preferences.edit.use_global_undo = False
+    try:
+        for incident in incidents:
+            video_filename = incident['video_filename']
+            beep_timestamp = incident['beep_timestamp']
             print(f"Adding incident {video_filename=}, {beep_timestamp=} s")
             add_incident_to_timeline(
-                video_filename=video_filename,
-                beep_timestamp=beep_timestamp,
+                sequences=sequences,
+                video_exists=video_exists,
                 context_before=args.context_before,
                 context_after=args.context_after,
-                start_frame=int(
-                    i_incident
-                    * (args.context_before + args.context_after)
-                    * fps
-                ),
                 fps=fps,
-                channel=1 + (i_incident % 2) * 2
+                **incident,
             )
-            i_incident += 1
+    finally:
+        bpy.context.preferences.edit.use_global_undo = use_global_undo
 
-    bpy.context.scene.frame_end = int(
-        i_incident
-        * (args.context_before + args.context_after)
-        * fps
-    )
+    bpy.context.scene.frame_end = int(len(incidents) * frame_stride)
 
     # Update view in sequence editor
     # - Set frame range to include all strips
@@ -142,61 +247,85 @@ def blender_main():
 
 
 def add_incident_to_timeline(
+    sequences,
+    video_exists: dict,
     video_filename: str,
     beep_timestamp: float,
     context_before: float,
     context_after: float,
     start_frame: int,
+    frame_start: int,
+    frame_offset_start: int,
+    frame_final_duration: int,
     fps: float,
     channel: int,
 ):
+    """
+    Insert the clip containing the beep plus, if needed and available,
+    its predecessor and successor clips for additional context.
+
+    frame_start, frame_offset_start, and frame_final_duration refer to
+    the clip containing the beep and are computed in blender_main for
+    all incidents at once.
+
+    video_exists caches whether neighbor clips exist so that we only check
+    the file system once per clip, not once per incident.
+    """
     v_sequence, a_sequence, frame_duration_original = insert_movie(
+        sequences=sequences,
         video_filename=video_filename,
-        frame_start=int(
-            start_frame
-            + max(0, context_before - beep_timestamp) * fps
-            # ^ gap for prev context clip
-            - max(0, beep_timestamp - context_before) * fps
-        ),
-        frame_offset_start=int(max(0, beep_timestamp - context_before) * fps),
-        frame_final_duration=int(
-            (
-                min(context_before, beep_timestamp)
-                + context_after
-            )
-            * fps
-        ),
+        frame_start=frame_start,
+        frame_offset_start=frame_offset_start,
+        frame_final_duration=frame_final_duration,
         channel=channel,
     )
 
     # Extract the number from a file name like 'CYQ_0001.MP4':
-    video_path = pathlib.Path(video_filename)
-    video_id = int(video_path.stem.split('_')[1])
+    match = CYQ_FILENAME_RE.search(str(video_filename))
+    if match is None:
+        print(f"Not looking for neighbor clips of {video_filename}")
+        return
+    # Swap only the number so that we keep the case of the rest of the
+    # name, e.g., 'cyq_0001.mp4' -> 'cyq_0002.mp4':
+    video_id = int(match.group(1))
+    name_before_id = str(video_filename)[:match.start(1)]
+    name_after_id = str(video_filename)[match.end(1):]
+    id_width = len(match.group(1))
 
     # We may exceed the length of the current video with the
     # requested amount of context.
     # -> Support up to one predecessor and one successor clip:
     if beep_timestamp < context_before:
-        prev_video_path = video_path.parent / f"CYQ_{video_id - 1:04d}.MP4"
-        if prev_video_path.exists():
-            frame_final_duration = (context_before - beep_timestamp) * fps
+        prev_video_path = pathlib.Path(
+            f"{name_before_id}{video_id - 1:0{id_width}d}{name_after_id}"
+        )
+        if prev_video_path not in video_exists:
+            video_exists[prev_video_path] = prev_video_path.exists()
+        if video_exists[prev_video_path]:
+            prev_frame_final_duration = (context_before - beep_timestamp) * fps
             insert_movie(
+                sequences=sequences,
                 video_filename=prev_video_path,
-                frame_start=int(start_frame - frame_final_duration),
+                frame_start=int(start_frame - prev_frame_final_duration),
                 frame_offset_start=int(
-                    frame_duration_original - frame_final_duration
+                    frame_duration_original - prev_frame_final_duration
                 ),
-                frame_final_duration=int(frame_final_duration),
+                frame_final_duration=int(prev_frame_final_duration),
                 channel=channel,
             )
     if beep_timestamp * fps > frame_duration_original - context_after * fps:
-        next_video_path = video_path.parent / f"CYQ_{video_id + 1:04d}.MP4"
-        if next_video_path.exists():
+        next_video_path = pathlib.Path(
+            f"{name_before_id}{video_id + 1:0{id_width}d}{name_after_id}"
+        )
+        if next_video_path not in video_exists:
+            video_exists[next_video_path] = next_video_path.exists()
+        if video_exists[next_video_path]:
             frame_remaining_context = int(context_after * fps - (
                 frame_duration_original
                 - beep_timestamp * fps
             ))
             insert_movie(
+                sequences=sequences,
                 video_filename=next_video_path,
                 frame_start=int(
                     start_frame
@@ -210,6 +339,7 @@ def add_incident_to_timeline(
 
 
 def insert_movie(
+    sequences,
     video_filename: str,
     frame_start: int,
     frame_offset_start: int,
@@ -217,21 +347,28 @@ def insert_movie(
     channel: int,
 ):
     """
-    Insert a video and an audio strip for the given video filename.
+    Insert a video and an audio strip for the given video filename
+    into `sequences`, the scene's sequence editor strip collection.
 
     Blender defines frame_start differently than we define start_frame;
     frame_start is the value before frame_offset_start is added!
     So if we want to start seeing a video at frame 1 in our timeline
     from which we want to exclude the first 25 frames, then
     frame_start should be -25.
+
+    Unlike the sequencer.movie_strip_add operator, sequences.new_movie
+    has no option to add the sound along with the movie, hence the
+    separate new_sound call. Using the operator instead would save
+    opening the file twice, but it needs a sequencer area in the context
+    and brings back the undo push and redraw of bpy.ops.
     """
-    v_sequence = bpy.context.scene.sequence_editor.sequences.new_movie(
+    v_sequence = sequences.new_movie(
         name=str(video_filename),
         filepath=str(video_filename),
         frame_start=frame_start,
         channel=channel+1,
     )
-    a_sequence = bpy.context.scene.sequence_editor.sequences.new_sound(
+    a_sequence = sequences.new_sound(
         name=str(video_filename),
         filepath=str(video_filename),
         frame_start=frame_start,
@@ -249,30 +386,49 @@ def insert_movie(
         frame_final_duration,
         frame_duration_original - frame_offset_start
     )
-    v_sequence.frame_start = frame_start
+    # frame_start has already been set by new_movie/new_sound.
+    # Every property write tags the sequencer for an update, so only
+    # write what actually changes:
     v_sequence.frame_offset_start = frame_offset_start
     v_sequence.frame_final_duration = frame_final_duration
-    a_sequence.frame_start = frame_start
     a_sequence.frame_offset_start = frame_offset_start
     a_sequence.frame_final_duration = frame_final_duration
 
     return v_sequence, a_sequence, frame_duration_original
 
 
-def get_exif(
+def get_video_metadata(
     file_path: pathlib.Path,
 ):
-    exiftool_process = subprocess.Popen(
-        ['exiftool', str(file_path)],
-        stdout=subprocess.PIPE,
+    """
+    Get width, height, and frame rate of the first video stream in a file.
+    """
+    import subprocess
+
+    ffprobe_output = subprocess.check_output(
+        [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height,avg_frame_rate',
+            '-of', 'json',
+            str(file_path),
+        ],
+    )
+    streams = json.loads(ffprobe_output)['streams']
+    if len(streams) == 0:
+        raise ValueError(f"No video stream found in {file_path}")
+    stream = streams[0]
+    # The frame rate is a fraction such as '30000/1001', or '0/0' if
+    # ffprobe couldn't determine it:
+    fps_num, _, fps_den = stream['avg_frame_rate'].partition('/')
+    if int(fps_den or 1) == 0:
+        raise ValueError(f"Unknown frame rate of {file_path}")
+    return dict(
+        width=int(stream['width']),
+        height=int(stream['height']),
+        fps=int(fps_num) / int(fps_den or 1),
     )
-    metrics = dict()
-    for line in exiftool_process.stdout.readlines():
-        k, v = str(line).split(':', maxsplit=1)
-        metrics[k.strip()[2:]] = v.strip()[:-3]
-        # '[2:] is for removing the "b'" at the start
-        # '[:-3] is for removing the trailing '\\n'
-    return metrics
 
 
 if __name__ == '__main__':
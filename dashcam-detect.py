@@ -2,15 +2,23 @@
 
 # Helpful resource: https://apmonitor.com/dde/index.php/Main/AudioAnalysis
 
-import io
+import os
+import contextlib
+import functools
+import concurrent.futures
 import subprocess
 import argparse
 import pathlib
 import json
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.io
 import scipy.signal
+import scipy.fft
+
+try:
+    import pyfftw.interfaces.cache
+    import pyfftw.interfaces.scipy_fft
+except ImportError:
+    pyfftw = None
 
 
 def main():
@@ -52,12 +60,28 @@ def main():
     args = parser.parse_args()
 
     triple_beeps_by_file = dict()
-    for video_path in args.videos:
-        triple_beeps_by_file[str(video_path.name)] = process_video(
-            video_path,
-            plot_volume=args.plot_volume,
-            plot_spectrogram=args.plot_spectrogram,
-        )
+    if args.videos:
+        # Videos are independent of each other, so process them in
+        # parallel. Each worker has an ffmpeg process of its own decoding
+        # alongside it, hence only half as many workers as there are CPUs.
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(
+                len(args.videos),
+                max(1, (os.cpu_count() or 1) // 2),
+            ),
+        ) as executor:
+            all_triple_beeps = executor.map(
+                functools.partial(
+                    process_video,
+                    plot_volume=args.plot_volume,
+                    plot_spectrogram=args.plot_spectrogram,
+                ),
+                args.videos,
+            )
+            for video_path, triple_beeps in zip(
+                args.videos, all_triple_beeps
+            ):
+                triple_beeps_by_file[str(video_path.name)] = triple_beeps
 
     if args.json_in:
         with open(args.json_in, 'r') as f:
@@ -85,11 +109,17 @@ def process_video(
         plot_spectrogram=False,
 ):
     print(f"Reading {video_path}…")
+    # Let ffmpeg pick the first (left) channel and resample to 8 kHz
+    # while decoding, and have it output raw 16 bit PCM that we can use
+    # as is:
+    sample_rate = 8000
     ffmpeg_cmd = [
         'ffmpeg',
         '-hide_banner', '-loglevel', 'error',
         '-i', str(video_path),
-        '-f', 'wav',
+        '-af', 'pan=mono|c0=c0',
+        '-ar', str(sample_rate),
+        '-f', 's16le',
         '-'
     ]
     print(" ".join(ffmpeg_cmd))
@@ -97,42 +127,53 @@ def process_video(
         ffmpeg_cmd,
         stdout=subprocess.PIPE,
     )
-    audio_file = io.BytesIO(ffmpeg_process.stdout.read())
-
-    sample_rate, samples = scipy.io.wavfile.read(audio_file)
-    samples = samples[:, 0]  # use only one of the two stereo channels
-
-    # downsample:
-    target_rate = 8000
-    resampling_ratio = target_rate / sample_rate
-    samples = scipy.signal.resample(
-        samples,
-        int(len(samples) * resampling_ratio),
-    )
-    sample_rate = target_rate
+    # Read the samples straight into an array that doubles in size
+    # whenever it is full, rather than piecing chunks of bytes together:
+    pcm = np.empty(60 * sample_rate, dtype='<i2')
+    n_bytes = 0
+    while True:
+        if n_bytes == pcm.nbytes:
+            pcm = np.concatenate((pcm, np.empty_like(pcm)))
+        n_read = ffmpeg_process.stdout.readinto(
+            memoryview(pcm).cast('B')[n_bytes:]
+        )
+        if not n_read:
+            break
+        n_bytes += n_read
+    if ffmpeg_process.wait() != 0:
+        raise subprocess.CalledProcessError(
+            ffmpeg_process.returncode,
+            ffmpeg_cmd,
+        )
+    # Single precision is plenty for 16 bit audio and halves the memory
+    # the samples take up:
+    samples = pcm[:n_bytes // pcm.itemsize].astype(np.float32)
 
     print('Sampling Rate:', sample_rate)
     print('Audio Shape:', np.shape(samples))
 
     f_min = 2000
     f_max = 3000
-    ex_times, ex_volume = extract_frequency(
+    ex_times, ex_volume, *spectrum = extract_frequency(
         samples,
         sample_rate,
         f_min=f_min,
-        f_max=f_max
+        f_max=f_max,
+        return_spectrogram=plot_spectrogram,
     )
 
     # find peaks
-    sos = scipy.signal.iirfilter(
-        4,
-        Wn=[10, 1100],  # critical frequencies
-        fs=sample_rate,
-        btype="bandpass",
-        ftype="butter",
-        output="sos",
+    # A triple beep needs at least three frames (and with no or very
+    # short audio, there may be no frame at all):
+    if len(ex_volume) < 3:
+        print(f"Audio of {video_path} too short to look for beeps")
+        return []
+    # Start the filter in its steady state for the first frame's volume,
+    # otherwise it rings for several seconds and yields spurious peaks:
+    sos = design_peak_filter(sample_rate)
+    yfilt, _ = scipy.signal.sosfilt(
+        sos, ex_volume, zi=scipy.signal.sosfilt_zi(sos) * ex_volume[0]
     )
-    yfilt = scipy.signal.sosfilt(sos, ex_volume)
 
     peaks, props = scipy.signal.find_peaks(
         yfilt,
@@ -142,7 +183,12 @@ def process_video(
     #     ex_volume,
     #     widths=(int(.002 * sample_rate), int(.3 * sample_rate)),
     # )
-    peak_times = ex_times[peaks]
+    # The filter delays the peaks; shift them back to where the beeps are:
+    frame_duration = ex_times[1] - ex_times[0]
+    peak_times = (
+        ex_times[peaks]
+        - peak_filter_delay(sample_rate) * frame_duration
+    )
     peak_vals = yfilt[peaks]
     print(f"{peak_times=}\n{peak_vals=}")
     triple_beep_times = find_triple_beeps(
@@ -153,6 +199,7 @@ def process_video(
     print(f"{triple_beep_times=}")
 
     if plot_volume:
+        plt = import_pyplot()
         fig, ax = plt.subplots(figsize=(8, 6))
         ax.plot(ex_times, ex_volume)
         ax.plot(ex_times, yfilt)
@@ -163,16 +210,23 @@ def process_video(
         fig.savefig(f"{video_path.stem}_hz{f_min}-{f_max}.png")
 
     if plot_spectrogram:
+        plt = import_pyplot()
         fig, ax = plt.subplots(figsize=(8, 6))
-        freqs, times, spectrogram = scipy.signal.stft(samples, fs=sample_rate)
+        freqs, spectrogram = spectrum
+        times = ex_times
         print(
             f"{np.shape(freqs)=}, {np.shape(times)=}, {np.shape(spectrogram)=}"
         )
         print(f"{len(freqs)=}, {len(times)=}")
+        # Same as np.log(np.abs(spectrogram) + 1e-10), but without
+        # allocating a new spectrogram-sized array for every step:
+        log_magnitude = np.abs(spectrogram)
+        log_magnitude += 1e-10
+        np.log(log_magnitude, out=log_magnitude)
         ax.pcolormesh(
             times,
             freqs,
-            np.log(np.abs(spectrogram) + 1e-10),
+            log_magnitude,
             shading='gouraud',
             cmap='inferno'
         )
@@ -184,32 +238,163 @@ def process_video(
     return triple_beep_times
 
 
+def import_pyplot():
+    """
+    Import and return matplotlib.pyplot. Loading matplotlib takes a while,
+    so only do it when we actually plot something.
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # we only ever save plots to files
+    matplotlib.rcParams['path.simplify_threshold'] = 1.0
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def find_triple_beeps(peak_times, td_min, td_max):
+    """
+    Find three consecutive peaks that are between td_min and td_max
+    seconds apart and return the times of the middle peaks.
+    """
     peak_time_diffs = np.diff(peak_times)
     print(f"{peak_time_diffs=}")
-    triple_beeps = []
-    for i, peak_time_diff in enumerate(peak_time_diffs):
-        if i == 0:
-            continue
-        if (
-            td_min <= peak_time_diff <= td_max
-            and td_min <= peak_time_diffs[i-1] <= td_max
-        ):
-            triple_beeps.append(peak_times[i])
-    return triple_beeps
-
-
-def extract_frequency(data, sample_rate: int, f_min=2000, f_max=3000):
+    diff_in_range = (td_min <= peak_time_diffs) & (peak_time_diffs <= td_max)
+    # Peak i is a middle peak if the diffs before and after it are in range:
+    is_triple_beep = diff_in_range[:-1] & diff_in_range[1:]
+    return peak_times[1:-1][is_triple_beep].tolist()
+
+
+@functools.lru_cache(maxsize=8)
+def design_peak_filter(sample_rate: int):
+    """
+    Get the second-order sections of the band-pass filter that is applied
+    to the volume before finding peaks. Videos usually share a sample
+    rate, so this is cached.
+    """
+    return scipy.signal.iirfilter(
+        4,
+        Wn=[10, 1100],  # critical frequencies
+        fs=sample_rate,
+        btype="bandpass",
+        ftype="butter",
+        output="sos",
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def peak_filter_delay(sample_rate: int):
+    """
+    Get the number of frames by which the peak filter delays a short
+    pulse in the volume, i.e., where its impulse response peaks.
+
+    The filter is designed for sample_rate but runs on the volume's STFT
+    frames, so its pass band lies right on the rhythm of a triple beep.
+    Filtering forward and backward (sosfiltfilt) to get rid of the delay
+    would square its roll-off there and merge neighboring beeps, so we
+    filter forward only and correct the peak times by this delay instead.
+    """
+    impulse = np.zeros(64)
+    impulse[0] = 1
+    return int(np.argmax(
+        scipy.signal.sosfilt(design_peak_filter(sample_rate), impulse)
+    ))
+
+
+def extract_frequency(
+        data,
+        sample_rate: int,
+        f_min=2000,
+        f_max=3000,
+        return_spectrogram=False,
+):
     """
     Get the volume over time of a given frequency band.
+
+    If return_spectrogram is set, the frequencies and the complex
+    spectrogram that the volume was computed from are returned as well,
+    e.g., for plotting.
+
+    The volume is the sum of the STFT magnitudes within the band.
+    The peak height threshold in process_video is tuned to this measure,
+    so a cheaper band-pass filter plus envelope, which scales differently
+    for anything but a pure tone, can't simply be swapped in.
     """
     # With help from ChatGPT…
-    freqs, times, spectrogram = scipy.signal.stft(data, fs=sample_rate)
-    f_band_indices = np.where((freqs >= f_min) & (freqs <= f_max))[0]
-    f_band = np.abs(spectrogram[f_band_indices])
-    volume = np.sum(f_band, axis=0)
+    nperseg = 256
+    hop = nperseg // 2
+    # Only use frames that lie entirely within the signal. Frame i then
+    # covers data[i * hop:i * hop + nperseg]:
+    if len(data) < nperseg:  # not even a single frame
+        n_frames = 0
+    else:
+        n_frames = (len(data) - nperseg) // hop + 1
+    times = (np.arange(n_frames) * hop + nperseg / 2) / sample_rate
+    freqs = scipy.fft.rfftfreq(nperseg, d=1 / sample_rate)
+    # freqs is sorted, so the band is a contiguous range of rows. Slicing
+    # gives a view instead of gathering a copy of the rows:
+    f_band_start = np.searchsorted(freqs, f_min, side='left')
+    f_band_stop = np.searchsorted(freqs, f_max, side='right')
+
+    # Compute the STFT a block of frames at a time and only keep the
+    # volume of each block. This way, the complex spectrogram (and its
+    # magnitudes) never exist for the whole signal at once, unless we
+    # are asked to return it. Consecutive blocks of data overlap by
+    # nperseg - hop samples so that no frame is lost at their seams:
+    block_size = 2048
+    volume = np.empty(n_frames, dtype=np.result_type(data, np.float32))
+    spectrogram_blocks = []
+    with fft_backend():
+        for block_start in range(0, n_frames, block_size):
+            block_stop = min(block_start + block_size, n_frames)
+            _, _, spectrogram_block = scipy.signal.stft(
+                data[block_start * hop:(block_stop - 1) * hop + nperseg],
+                fs=sample_rate,
+                nperseg=nperseg,
+                noverlap=nperseg - hop,
+                nfft=nperseg,
+                return_onesided=True,
+                boundary=None,
+                padded=False,
+            )
+            volume[block_start:block_stop] = np.sum(
+                np.abs(spectrogram_block[f_band_start:f_band_stop]),
+                axis=0,
+            )
+            if return_spectrogram:
+                spectrogram_blocks.append(spectrogram_block)
+    if return_spectrogram:
+        spectrogram = np.concatenate(
+            [np.empty((len(freqs), 0), dtype=np.complex64)]
+            + spectrogram_blocks,
+            axis=1,
+        )
+        return times, volume, freqs, spectrogram
     return times, volume
 
 
+def fft_backend():
+    """
+    Context manager for scipy.fft (and therefore the STFT) to use FFTW if
+    pyFFTW is installed. Otherwise, scipy's own FFT is used.
+    """
+    if pyfftw is None:
+        return contextlib.nullcontext()
+    enable_fftw_cache()
+    return scipy.fft.set_backend(pyfftw.interfaces.scipy_fft)
+
+
+@functools.cache
+def enable_fftw_cache():
+    """
+    Keep FFTW plans around so that frames of the same size reuse them.
+
+    The cache runs a keepalive thread, so this must only be called where
+    the FFT is actually used (i.e., in the worker processes) and not at
+    import time. Otherwise the process pool would fork a process that
+    already has a thread running.
+    """
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+
+
 if __name__ == '__main__':
     main()